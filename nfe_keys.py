@@ -0,0 +1,89 @@
+"""Extração das chaves de acesso (44 dígitos) de PDFs de NF-e.
+
+Fica fora do streamlit_app.py para que os workers do ProcessPoolExecutor
+consigam importar as funções: o Streamlit executa o script como um
+``__main__`` falso, recriado a cada rerun.
+"""
+import io
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, List, Sequence, Union
+
+from pypdf import PdfReader
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # fallback para o extrator puro-Python do pypdf
+    pdfium = None
+
+KEY_RE = re.compile(r"\b\d{44}\b", re.ASCII)
+
+# O PDFium não é thread-safe, nem em documentos diferentes, e o Streamlit roda
+# cada sessão numa thread própria: toda chamada ao PDFium passa por este lock
+_PDFIUM_LOCK = threading.Lock()
+
+# Caminho, conteúdo do PDF em memória ou arquivo binário já aberto
+PdfSource = Union[str, bytes, BinaryIO]
+
+
+def _pdf_text_pdfium(src: PdfSource) -> str:
+    """Texto do documento inteiro via PDFium (nativo), uma página por linha."""
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(src)
+        try:
+            parts: List[str] = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                parts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+            return "\n".join(parts)
+        finally:
+            pdf.close()
+
+
+def _reset_pdfium_lock() -> None:
+    """Initializer dos workers: o fork herda o lock travado pelo processo pai."""
+    global _PDFIUM_LOCK
+    _PDFIUM_LOCK = threading.Lock()
+
+
+def _pdf_text_pypdf(src: PdfSource) -> str:
+    if isinstance(src, bytes):
+        src = io.BytesIO(src)
+    elif not isinstance(src, str):
+        src.seek(0)
+    # close() libera os objetos já resolvidos; só fecha o stream se foi o pypdf que o abriu
+    with PdfReader(src) as reader:
+        return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def extract_keys_from_pdf(src: PdfSource) -> List[str]:
+    keys: List[str] = []
+    if pdfium is not None:
+        try:
+            keys = KEY_RE.findall(_pdf_text_pdfium(src))
+        except Exception:
+            keys = []
+    if not keys:
+        keys = KEY_RE.findall(_pdf_text_pypdf(src))
+    # dict preserva a ordem de inserção: dedup em uma passada só
+    return list(dict.fromkeys(keys))
+
+
+def extract_keys_from_pdfs(sources: Sequence[Union[str, bytes]]) -> List[List[str]]:
+    """Extrai as chaves de vários PDFs (caminhos ou bytes), um processo por arquivo.
+
+    Devolve uma lista por arquivo, na mesma ordem de ``sources``.
+    """
+    workers = min(len(sources), os.cpu_count() or 1)
+    if workers < 2:
+        return [extract_keys_from_pdf(src) for src in sources]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_reset_pdfium_lock) as ex:
+        # Com fork, os workers nascem no primeiro submit (map submete tudo de uma vez):
+        # segurando o lock, nenhuma outra sessão está dentro do PDFium nesse instante
+        with _PDFIUM_LOCK:
+            results = ex.map(extract_keys_from_pdf, sources)
+        return list(results)
@@ -1,98 +1,97 @@
-import os
+import hashlib
+import io
+import math
 import re
-from datetime import datetime
-from typing import List
+from datetime import date, datetime
+from functools import lru_cache
+from itertools import chain
+from typing import BinaryIO, List, Optional, Tuple, Union
 
 import streamlit as st
-from pypdf import PdfReader
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import mm
+from reportlab.lib.rl_accel import fp_str
 from reportlab.pdfbase import pdfmetrics
 
-KEY_RE = re.compile(r"\b\d{44}\b")
+from nfe_keys import extract_keys_from_pdfs
 
 
 # =========================
-# EXTRAÇÃO
+# UTIL
 # =========================
-def extract_keys_from_pdf(pdf_path: str) -> List[str]:
-    reader = PdfReader(pdf_path)
-    keys: List[str] = []
-    seen = set()
-
-    for page in reader.pages:
-        text = page.extract_text() or ""
-        for k in KEY_RE.findall(text):
-            if k not in seen:
-                seen.add(k)
-                keys.append(k)
-    return keys
-
-
-def extract_keys_from_uploaded_file(uploaded_file) -> List[str]:
-    """Extrai chaves de um UploadedFile do Streamlit."""
-    ts = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
-    tmp_in = os.path.join("/tmp", f"entrada_{ts}.pdf")
-    with open(tmp_in, "wb") as f:
-        f.write(uploaded_file.read())
-    keys = extract_keys_from_pdf(tmp_in)
-    try:
-        os.remove(tmp_in)
-    except Exception:
-        pass
-    return keys
+_DATE_FMT = "%d/%m/%Y"
+_DATE_RE = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})", re.ASCII)  # mesmo formato aceito por _DATE_FMT
+_HORA_VAZIA = "_____ : _____"
+_HORA_PLACEHOLDERS = frozenset((_HORA_VAZIA, "_____:_____", "____ : ____"))
 
 
-# =========================
-# UTIL
-# =========================
 def today_br() -> str:
-    return datetime.now().strftime("%d/%m/%Y")
+    return datetime.now().strftime(_DATE_FMT)
 
 
-def normalize_data(d: str) -> str:
+def normalize_data(d: str, default: Optional[str] = None) -> str:
+    """Data no formato dd/mm/aaaa; se inválida, ``default`` (ou a data de hoje)."""
     s = (d or "").strip()
-    try:
-        dt = datetime.strptime(s, "%d/%m/%Y")
-        return dt.strftime("%d/%m/%Y")
-    except Exception:
-        return today_br()
+    # Regex em vez de strptime: lixo não paga exceção e datas válidas não reinterpretam o formato
+    m = _DATE_RE.fullmatch(s)
+    if m:
+        day, month, year = map(int, m.groups())
+        try:
+            return date(year, month, day).strftime(_DATE_FMT)
+        except ValueError:
+            pass
+    return default or today_br()
 
 
 def normalize_hora(h: str) -> str:
-    if not h or not h.strip():
-        return "_____ : _____"
-    s = h.strip()
-    if s in {"_____ : _____", "_____:_____", "____ : ____"}:
-        return "_____ : _____"
-    return s
+    s = (h or "").strip()
+    return _HORA_VAZIA if not s or s in _HORA_PLACEHOLDERS else s
 
 
-def write_txt(out_path: str, keys: List[str]) -> None:
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(keys))
-        f.write("\n")
+def render_txt(keys: List[str]) -> bytes:
+    return ("\n".join(keys) + "\n").encode("utf-8")
 
 
 # =========================
 # PDF HELPERS
 # =========================
+# Geometria da página e alturas de linha: constantes, calculadas na importação
+_PAGE_GEOMETRY = (A4[0], A4[1], 16 * mm, 16 * mm, A4[1] - 16 * mm)
+_LINE_H = 6.0 * mm
+_LIST_LINE_H = 5.0 * mm
+_GUTTER = 16 * mm
+
+# ----- Rodapé fixo (assinaturas) -----
+_SIG_LINE_Y = 22 * mm
+_SIG_LABEL_Y = _SIG_LINE_Y - 8
+_SIG_BLOCK_TOP = _SIG_LINE_Y + 6 * mm
+
+# TOTAL acima das assinaturas; a lista termina uma linha acima dele
+_TOTAL_MIN_Y = _SIG_BLOCK_TOP + 10 * mm
+_LIST_BOTTOM = _TOTAL_MIN_Y + _LIST_LINE_H
+
+# Espaço entre última chave e TOTAL (em linhas da lista)
+_GAP_KEYS_TO_TOTAL = 2.2
+
+# Toda chave tem exatamente 44 dígitos (KEY_RE), então a largura é sempre a deste texto
+_KEY_SAMPLE = "0" * 44
+
+
 def _page_geometry():
-    w, h = A4
-    left = 16 * mm
-    right = 16 * mm
-    top = h - 16 * mm
-    return w, h, left, right, top
+    return _PAGE_GEOMETRY
+
+
+@lru_cache(maxsize=256)
+def _unit_width(text: str, font: str) -> float:
+    """Largura do texto em corpo 1; a largura escala linearmente com o tamanho."""
+    return pdfmetrics.stringWidth(text, font, 1.0)
 
 
 def _fit_font_size_for_column(text_sample: str, col_width: float, font: str, max_size: float) -> float:
-    size = max_size
-    while size >= 7.0:
-        if pdfmetrics.stringWidth(text_sample, font, size) <= col_width:
-            return size
-        size -= 0.2
-    return 7.0
+    # Maior tamanho (em passos de 0.2) que cabe na coluna, limitado a [7.0, max_size]
+    size = math.floor(col_width / _unit_width(text_sample, font) * 5) / 5
+    return max(7.0, min(max_size, size))
 
 
 def _pages_for(n_items: int, cols: int, lines_per_col: int) -> int:
@@ -111,16 +110,19 @@ def _choose_columns_and_font(
     max_font: float,
     min_font_ok: float = 8.5,
 ):
-    sample = max(keys, key=len) if keys else "0" * 44
-
     avail2 = w - left - right - gutter * 1
     col_w2 = avail2 / 2
-    size2 = _fit_font_size_for_column(sample, col_w2, font, max_font)
+    size2 = _fit_font_size_for_column(_KEY_SAMPLE, col_w2, font, max_font)
+
+    # Tudo cabe em uma página com 2 colunas: 3 colunas não teriam como economizar páginas
+    if len(keys) <= 2 * lines_per_col:
+        return 2, size2, col_w2
+
     pages2 = _pages_for(len(keys), 2, lines_per_col)
 
     avail3 = w - left - right - gutter * 2
     col_w3 = avail3 / 3
-    size3 = _fit_font_size_for_column(sample, col_w3, font, max_font)
+    size3 = _fit_font_size_for_column(_KEY_SAMPLE, col_w3, font, max_font)
     pages3 = _pages_for(len(keys), 3, lines_per_col)
 
     if size3 >= min_font_ok and pages3 < pages2:
@@ -132,124 +134,143 @@ def _choose_columns_and_font(
 # =========================
 # PDF (FINAL)
 # =========================
-def render_pdf(out_path: str, data: str, hora: str, keys: List[str]) -> None:
-    c = canvas.Canvas(out_path, pagesize=A4)
+def render_pdf(out: Union[str, BinaryIO], data: str, hora: str, keys: List[str]) -> None:
+    """Desenha o PDF em ``out``: um caminho ou um arquivo binário (ex.: BytesIO)."""
+    c = canvas.Canvas(out, pagesize=A4, pageCompression=1)
 
     w, h, left, right, top = _page_geometry()
 
     font_main = "Courier"
     font_list = "Courier"
 
-    line_h = 6.0 * mm
-
-    # ----- Rodapé fixo (assinaturas) -----
-    sig_line_y = 22 * mm
-    label_y = sig_line_y - 8
-    sig_block_top = sig_line_y + 6 * mm
-
-    # TOTAL acima das assinaturas
-    total_min_y = sig_block_top + 10 * mm
-
-    # Espaço entre última chave e TOTAL
-    gap_keys_to_total = 2.2
-
-    gutter = 16 * mm
-
     y = top
+    current_font = (None, None)
+
+    def set_font(font: str, size: float) -> None:
+        # Só emite Tf quando fonte/tamanho mudam de fato
+        nonlocal current_font
+        if (font, size) != current_font:
+            c.setFont(font, size)
+            current_font = (font, size)
 
     def new_page_repeat_title():
-        nonlocal y, w, h, left, right, top
+        nonlocal current_font
         c.showPage()
-        w, h, left, right, top = _page_geometry()
-        y = top
-        c.setFont(font_main, 11)
-        c.drawString(left, y, "CHAVES DE ACESSO:")
-        y -= line_h * 1.1
+        current_font = (None, None)  # showPage volta o canvas ao estado inicial
+        set_font(font_main, 11)
+        c.drawString(left, top, "CHAVES DE ACESSO:")
 
     # ===== HEADER COM CAIXAS =====
     header_h = 9 * mm
     c.rect(left, y - header_h + 2, w - left - right, header_h, stroke=1, fill=0)
-    c.setFont(font_main, 11)
+    set_font(font_main, 11)
     c.drawString(left + 3 * mm, y - 6 * mm, f"CLIENTE:  ArtStones     DATA DA COLETA:  {data}")
     y -= header_h + 4 * mm
 
     box_w = 55 * mm
     box_h = 22 * mm
     c.rect(left, y - box_h, box_w, box_h, stroke=1, fill=0)
-    c.setFont(font_main, 11)
+    set_font(font_main, 11)
     c.drawString(left + 3 * mm, y - 7 * mm, "HORA DA COLETA:")
     c.drawString(left + 3 * mm, y - 16 * mm, hora)
     y -= box_h + 12 * mm
 
-    c.setFont(font_main, 11)
+    set_font(font_main, 11)
     c.drawString(left, y, "CHAVES DE ACESSO:")
-    y -= line_h * 1.0
+    y -= _LINE_H * 1.0
 
     # ===== LISTA =====
-    list_line_h = 5.0 * mm
-    list_bottom = total_min_y + (list_line_h * 1.0)
-
-    usable_h = y - list_bottom
-    lines_per_col = max(1, int(usable_h // list_line_h))
+    usable_h = y - _LIST_BOTTOM
+    lines_per_col = max(1, int(usable_h // _LIST_LINE_H))
 
     cols, list_size, col_w = _choose_columns_and_font(
         keys=keys,
         w=w,
         left=left,
         right=right,
-        gutter=gutter,
+        gutter=_GUTTER,
         lines_per_col=lines_per_col,
         font=font_list,
         max_font=10.0,
         min_font_ok=8.5,
     )
 
-    idx = 0
-    lowest_y_on_page = y
+    # Páginas de continuação só repetem o título: cabem mais linhas por coluna
+    cont_y = top - _LINE_H * 1.1
+    cont_lines = max(1, int((cont_y - _LIST_BOTTOM) // _LIST_LINE_H))
 
-    while idx < len(keys):
-        page_start_y = y
-        lowest_y_on_page = y
+    # (y inicial, linhas por coluna, chaves) de cada página, definidos antes de desenhar
+    first_n = cols * lines_per_col
+    cont_n = cols * cont_lines
+    pages = [(y, lines_per_col, keys[:first_n])] if keys else []
+    pages += [(cont_y, cont_lines, keys[i:i + cont_n]) for i in range(first_n, len(keys), cont_n)]
 
-        for col in range(cols):
-            x = left + col * (col_w + gutter)
-            yy = page_start_y
-            c.setFont(font_list, list_size)
+    xs = [left + col * (col_w + _GUTTER) for col in range(cols)]
+    lowest_y_on_page = y
 
-            for _ in range(lines_per_col):
-                if idx >= len(keys):
-                    break
-                c.drawString(x, yy, keys[idx])
-                lowest_y_on_page = min(lowest_y_on_page, yy)
-                yy -= list_line_h
-                idx += 1
+    for page_no, (page_y, page_lines, chunk) in enumerate(pages):
+        if page_no:
+            new_page_repeat_title()
+        set_font(font_list, list_size)
 
-            if idx >= len(keys):
+        for col, x in enumerate(xs):
+            col_keys = chunk[col * page_lines:(col + 1) * page_lines]
+            if not col_keys:
                 break
+            # Um bloco BT/ET por coluna escrito direto em operadores PDF (o mesmo que
+            # beginText/textLine geraria): chaves são só dígitos, dispensam escape,
+            # e a fonte já está no estado gráfico via set_font.
+            lines = " ".join([f"({k}) Tj T*" for k in col_keys])
+            c.addLiteral(f"BT 1 0 0 1 {fp_str(x, page_y)} Tm {fp_str(_LIST_LINE_H)} TL {lines} ET")
 
-        if idx < len(keys):
-            new_page_repeat_title()
-            usable_h = y - list_bottom
-            lines_per_col = max(1, int(usable_h // list_line_h))
+    if pages:
+        page_y, page_lines, chunk = pages[-1]
+        lowest_y_on_page = page_y - (min(len(chunk), page_lines) - 1) * _LIST_LINE_H
 
     # ===== TOTAL =====
-    total_y = lowest_y_on_page - (list_line_h * gap_keys_to_total)
-    total_y = max(total_y, total_min_y)
+    total_y = lowest_y_on_page - (_LIST_LINE_H * _GAP_KEYS_TO_TOTAL)
+    total_y = max(total_y, _TOTAL_MIN_Y)
 
-    c.setFont(font_main, 11)
+    set_font(font_main, 11)
     c.drawString(left, total_y, f"TOTAL DA REMESSA:  {len(keys)} VOLUMES")
 
     # ===== ASSINATURAS =====
-    c.line(left, sig_line_y, w * 0.45, sig_line_y)
-    c.line(w * 0.58, sig_line_y, w - right, sig_line_y)
-
-    c.setFont(font_main, 10)
-    c.drawString(left, label_y, "ASSINATURA DO REPRESENTANTE")
-    c.drawString(w * 0.58, label_y, "ASSINATURA DO MOTORISTA")
+    # As duas linhas num único path (um só operador de traço)
+    p = c.beginPath()
+    p.moveTo(left, _SIG_LINE_Y)
+    p.lineTo(w * 0.45, _SIG_LINE_Y)
+    p.moveTo(w * 0.58, _SIG_LINE_Y)
+    p.lineTo(w - right, _SIG_LINE_Y)
+    c.drawPath(p, stroke=1, fill=0)
+
+    set_font(font_main, 10)
+    c.drawString(left, _SIG_LABEL_Y, "ASSINATURA DO REPRESENTANTE")
+    c.drawString(w * 0.58, _SIG_LABEL_Y, "ASSINATURA DO MOTORISTA")
 
     c.save()
 
 
+# =========================
+# CACHE (reruns do Streamlit)
+# =========================
+@st.cache_data(show_spinner=False, max_entries=8)
+def cached_extract(pdf_blobs: Tuple[bytes, ...]) -> List[str]:
+    """Chaves de todos os PDFs, na ordem de envio e sem duplicadas; cache pelo conteúdo."""
+    return list(dict.fromkeys(chain.from_iterable(extract_keys_from_pdfs(pdf_blobs))))
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def cached_render_pdf(data: str, hora: str, keys_digest: str, _keys: List[str]) -> bytes:
+    """PDF final em bytes; reaproveitado enquanto data, hora e chaves não mudam.
+
+    O Streamlit não hasheia parâmetros com ``_``: a lista de chaves entra no cache
+    pelo ``keys_digest``, sem percorrer as chaves uma a uma em Python a cada clique.
+    """
+    buf = io.BytesIO()
+    render_pdf(buf, data, hora, _keys)
+    return buf.getvalue()
+
+
 # =========================
 # UI - Streamlit (SUPORTA MÚLTIPLOS PDFs)
 # =========================
@@ -258,7 +279,7 @@ st.title("Extrator de Chaves NF-e (PDF → PDF para imprimir)")
 
 pdfs = st.file_uploader("Envie 1 ou mais PDFs", type=["pdf"], accept_multiple_files=True)
 data = st.text_input("Data da coleta", value=today_br())
-hora = st.text_input("Hora da coleta", value="_____ : _____")
+hora = st.text_input("Hora da coleta", value=_HORA_VAZIA)
 
 col1, col2 = st.columns(2)
 with col1:
@@ -270,54 +291,46 @@ if pdfs:
     st.caption(f"{len(pdfs)} arquivo(s) selecionado(s).")
 
 if st.button("Gerar arquivos", disabled=(not pdfs)):
+    # Um único "agora" para a data padrão e o nome dos arquivos
+    now = datetime.now()
+    ts = now.strftime("%Y%m%d-%H%M%S")
+
     # Normaliza campos
-    data_norm = normalize_data(data)
+    data_norm = normalize_data(data, now.strftime(_DATE_FMT))
     hora_norm = normalize_hora(hora)
 
     # Extrai e junta chaves preservando ordem entre arquivos e removendo duplicadas
-    all_keys: List[str] = []
-    seen = set()
-
-    for up in pdfs:
-        keys = extract_keys_from_uploaded_file(up)
-        for k in keys:
-            if k not in seen:
-                seen.add(k)
-                all_keys.append(k)
+    with st.spinner("Lendo PDFs..."):
+        all_keys = cached_extract(tuple(up.getvalue() for up in pdfs))
 
     if not all_keys:
         st.error("Não encontrei chaves de acesso (44 dígitos) nos PDFs enviados.")
         st.stop()
 
-    ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-    out_pdf = os.path.join("/tmp", f"Chaves_de_Acesso_{ts}.pdf")
-    out_txt = os.path.join("/tmp", f"Chaves_{ts}.txt")
-
-    # Gera PDF final
-    render_pdf(out_pdf, data_norm, hora_norm, all_keys)
+    # TXT das chaves: também serve de chave de cache barata para o PDF
+    txt_bytes = render_txt(all_keys)
 
-    # TXT opcional
-    if gerar_txt:
-        write_txt(out_txt, all_keys)
+    # Gera PDF final em memória
+    with st.spinner("Gerando PDF..."):
+        pdf_bytes = cached_render_pdf(data_norm, hora_norm, hashlib.sha1(txt_bytes).hexdigest(), all_keys)
 
     st.success(f"{len(all_keys)} chaves encontradas no total.")
 
-    with open(out_pdf, "rb") as f:
-        st.download_button(
-            "Baixar PDF pronto para imprimir",
-            data=f,
-            file_name=os.path.basename(out_pdf),
-            mime="application/pdf",
-        )
+    st.download_button(
+        "Baixar PDF pronto para imprimir",
+        data=pdf_bytes,
+        file_name=f"Chaves_de_Acesso_{ts}.pdf",
+        mime="application/pdf",
+    )
 
+    # TXT opcional
     if gerar_txt:
-        with open(out_txt, "rb") as f:
-            st.download_button(
-                "Baixar TXT (opcional)",
-                data=f,
-                file_name=os.path.basename(out_txt),
-                mime="text/plain",
-            )
+        st.download_button(
+            "Baixar TXT (opcional)",
+            data=txt_bytes,
+            file_name=f"Chaves_{ts}.txt",
+            mime="text/plain",
+        )
 
     if mostrar_preview:
         st.text_area("Prévia (primeiras 10 chaves)", "\n".join(all_keys[:10]), height=220)